@@ -7,59 +7,201 @@ Converts instructions into natural language questions and generates tool outputs
 import sys
 import os
 import json
-import argparse
-from bs4 import BeautifulSoup
-import warnings
+import functools
+import hashlib
+import re
 import time
-import boto3
-from botocore.config import Config
-from typing import Dict, Type, List
+import warnings
+import orjson
+from typing import Dict, List
 import importlib
 
 # Append necessary paths
 sys.path.append('../data/ma-bench/')
 sys.path.append('../data/tau-bench/')
 
+# Model used to rewrite instructions (cross-region profile with latency-optimized inference)
+USER_BEDROCK_MODEL_ID = "us.anthropic.claude-3-5-haiku-20241022-v1:0"
+
+# Bump when the prompt template in generate_question changes to invalidate cached questions
+PROMPT_TEMPLATE_VERSION = "1"
+
+# Generated questions are cached on disk so re-runs skip the Bedrock call
+QUESTION_CACHE_DIR = os.path.join("..", "data", "tau-bench", ".gt_cache")
+_question_memo: Dict[str, str] = {}
+
+# Bedrock batch inference requires at least this many records per job
+BATCH_MIN_RECORDS = 100
+BATCH_S3_PREFIX = "createGT-batch"
+
+# Extracts the rewritten instruction from the model output
+_QUESTION_RE = re.compile(r'<question>\s*(.*?)\s*</question>', re.DOTALL)
 
-def setup_bedrock_client(region_name="us-east-1"):
+
+def setup_bedrock_client(region_name="us-east-2", service_name="bedrock-runtime"):
     """
-    Set up and return a boto3 bedrock-runtime client with retry configuration.
+    Set up and return a boto3 Bedrock client with retry configuration.
     
     Args:
         region_name (str): AWS region name
+        service_name (str): 'bedrock-runtime', or 'bedrock' for batch inference jobs
         
     Returns:
-        boto3.client: Configured bedrock-runtime client
+        boto3.client: Configured Bedrock client
     """
+    # Imported here so --help and argument errors do not pay for loading boto3
+    import boto3
+    from botocore.config import Config
+    
     my_config = Config(
         region_name=region_name,
         signature_version='v4',
         retries={
-            'max_attempts': 3,
-            'mode': 'standard'
-        }
+            'max_attempts': 8,
+            'mode': 'adaptive'
+        },
+        max_pool_connections=32,
+        tcp_keepalive=True,
+        connect_timeout=5,
+        read_timeout=60
     )
     
     return boto3.client(
-        service_name="bedrock-runtime",
+        service_name=service_name,
         config=my_config,
     )
 
 
-def generate_question(instruction, bedrock_runtime):
+def setup_async_bedrock_client(region_name="us-east-2"):
     """
-    Generate a natural language question from an instruction using Claude model.
+    Set up an aioboto3 bedrock-runtime client with retry configuration.
+    
+    Args:
+        region_name (str): AWS region name
+        
+    Returns:
+        Async context manager yielding the bedrock-runtime client
+    """
+    import aioboto3
+    from aiobotocore.config import AioConfig
+    
+    my_config = AioConfig(
+        region_name=region_name,
+        signature_version='v4',
+        retries={
+            'max_attempts': 8,
+            'mode': 'adaptive'
+        },
+        max_pool_connections=32,
+        connect_timeout=5,
+        read_timeout=60
+    )
+    
+    session = aioboto3.Session()
+    return session.client("bedrock-runtime", config=my_config)
+
+
+def extract_question(question_text):
+    """
+    Extract the question from the <question></question> tags of a model response.
+    
+    Args:
+        question_text (str): Text returned by the model
+        
+    Returns:
+        str: Extracted question, or None if the tags are missing
+    """
+    match = _QUESTION_RE.search(question_text)
+    if match is None:
+        # Not cached, so the instruction is retried on the next run
+        print(f"Warning: no <question> tags in model response, skipping: {question_text.strip()[:200]!r}")
+        return None
+    return match.group(1)
+
+
+def question_cache_key(instruction):
+    """
+    Build the cache key for a generated question.
+    
+    Args:
+        instruction (str): The instruction to convert to a question
+        
+    Returns:
+        str: Hex digest of the model id, prompt template version and instruction
+    """
+    key_source = "\0".join([USER_BEDROCK_MODEL_ID, PROMPT_TEMPLATE_VERSION, instruction])
+    return hashlib.sha256(key_source.encode("utf-8")).hexdigest()
+
+
+def load_cached_question(instruction):
+    """
+    Look up a previously generated question in memory, then on disk.
     
     Args:
         instruction (str): The instruction to convert to a question
-        bedrock_runtime: boto3 bedrock-runtime client
         
     Returns:
-        str: Generated question
+        str: Cached question, or None on a cache miss
     """
-    # Select the model to use
-    user_bedrock_model_id = "anthropic.claude-3-sonnet-20240229-v1:0"
+    key = question_cache_key(instruction)
+    if key in _question_memo:
+        return _question_memo[key]
     
+    cache_path = os.path.join(QUESTION_CACHE_DIR, f"{key}.txt")
+    if os.path.exists(cache_path):
+        with open(cache_path, "r", encoding="utf-8") as file:
+            _question_memo[key] = file.read()
+        return _question_memo[key]
+    
+    return None
+
+
+def store_cached_question(instruction, question):
+    """
+    Save a generated question in memory and on disk.
+    
+    Args:
+        instruction (str): The instruction the question was generated from
+        question (str): Generated question
+    """
+    key = question_cache_key(instruction)
+    _question_memo[key] = question
+    
+    # Write to a temporary file and rename it, so an interrupted write never leaves a truncated entry
+    os.makedirs(QUESTION_CACHE_DIR, exist_ok=True)
+    cache_path = os.path.join(QUESTION_CACHE_DIR, f"{key}.txt")
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        file.write(question)
+    os.replace(tmp_path, cache_path)
+
+
+def cache_question(func):
+    """
+    Decorator that serves generate_question from the question cache when possible.
+    """
+    @functools.wraps(func)
+    async def wrapper(instruction, *args, **kwargs):
+        question = load_cached_question(instruction)
+        if question is None:
+            question = await func(instruction, *args, **kwargs)
+            if question is not None:
+                store_cached_question(instruction, question)
+        return question
+    
+    return wrapper
+
+
+def build_model_kwargs(instruction):
+    """
+    Build the Claude request body that rewrites an instruction into a question.
+    
+    Args:
+        instruction (str): The instruction to convert to a question
+        
+    Returns:
+        dict: Model request body
+    """
     # Remove specific text if found
     find = "You are reactive to the agent and will not say anything that is not asked. "
     if find in instruction:
@@ -112,25 +254,109 @@ def generate_question(instruction, bedrock_runtime):
         ]
     }
     
-    body = json.dumps(model_kwargs)
+    return model_kwargs
+
+
+@cache_question
+async def generate_question(instruction, bedrock_runtime):
+    """
+    Generate a natural language question from an instruction using Claude model.
+    
+    Args:
+        instruction (str): The instruction to convert to a question
+        bedrock_runtime: aioboto3 bedrock-runtime client
+        
+    Returns:
+        str: Generated question, or None if the response has no <question> tags
+    """
+    model_kwargs = build_model_kwargs(instruction)
+    body = orjson.dumps(model_kwargs)
     accept = "application/json"
     contentType = "application/json"
 
-    # Call the model
-    response = bedrock_runtime.invoke_model(
+    # Call the model; throttling is handled by the client's adaptive retry mode
+    response = await bedrock_runtime.invoke_model(
         body=body,
-        modelId=user_bedrock_model_id,
+        modelId=USER_BEDROCK_MODEL_ID,
         accept=accept,
-        contentType=contentType
+        contentType=contentType,
+        performanceConfigLatency="optimized"
     )
+    raw_body = await response["body"].read()
 
     # Process the response
-    response_body = json.loads(response.get("body").read())
+    response_body = orjson.loads(raw_body)
     question_text = response_body['content'][0]['text']
-    soup = BeautifulSoup(question_text, 'html.parser')
-    question = soup.find('question').string
     
-    return question
+    return extract_question(question_text)
+
+
+def generate_questions_batch(instructions, bucket, role_arn, poll_interval=60):
+    """
+    Generate questions with a Bedrock batch inference job and store them in the question cache.
+    
+    Args:
+        instructions (List[str]): Instructions to convert to questions
+        bucket (str): S3 bucket for the job input and output
+        role_arn (str): IAM role Bedrock assumes to read and write the bucket
+        poll_interval (int): Seconds between job status checks
+        
+    Returns:
+        List[str]: Generated questions in the order of the instructions (None if a record failed)
+    """
+    import boto3
+    
+    bedrock = setup_bedrock_client(service_name="bedrock")
+    s3 = boto3.client("s3")
+    
+    job_name = f"{BATCH_S3_PREFIX}-{int(time.time())}"
+    input_key = f"{BATCH_S3_PREFIX}/{job_name}/input.jsonl"
+    output_uri = f"s3://{bucket}/{BATCH_S3_PREFIX}/{job_name}/output/"
+    
+    # Write one record per instruction, using the index as the record id
+    records = b"\n".join(
+        orjson.dumps({"recordId": f"{i:011d}", "modelInput": build_model_kwargs(instruction)})
+        for i, instruction in enumerate(instructions)
+    )
+    s3.put_object(Bucket=bucket, Key=input_key, Body=records)
+    
+    job_arn = bedrock.create_model_invocation_job(
+        jobName=job_name,
+        roleArn=role_arn,
+        modelId=USER_BEDROCK_MODEL_ID,
+        inputDataConfig={"s3InputDataConfig": {"s3Uri": f"s3://{bucket}/{input_key}"}},
+        outputDataConfig={"s3OutputDataConfig": {"s3Uri": output_uri}},
+    )["jobArn"]
+    print(f"Started batch inference job {job_arn} for {len(instructions)} instructions")
+    
+    # Wait for the job to finish
+    while True:
+        status = bedrock.get_model_invocation_job(jobIdentifier=job_arn)["status"]
+        if status in ("Completed", "PartiallyCompleted"):
+            break
+        if status in ("Failed", "Stopped", "Expired"):
+            raise RuntimeError(f"Batch inference job {job_arn} ended with status {status}")
+        time.sleep(poll_interval)
+    
+    # Map the output records back to the instructions
+    job_id = job_arn.split("/")[-1]
+    output_key = f"{BATCH_S3_PREFIX}/{job_name}/output/{job_id}/input.jsonl.out"
+    output = s3.get_object(Bucket=bucket, Key=output_key)["Body"].read()
+    
+    questions = [None] * len(instructions)
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        record = orjson.loads(line)
+        model_output = record.get("modelOutput")
+        if not model_output:
+            continue
+        i = int(record["recordId"])
+        questions[i] = extract_question(model_output['content'][0]['text'])
+        if questions[i] is not None:
+            store_cached_question(instructions[i], questions[i])
+    
+    return questions
 
 
 def generate_tooloutput(actions, tools_map, data):
@@ -145,16 +371,39 @@ def generate_tooloutput(actions, tools_map, data):
     Returns:
         List: Results of tool actions
     """
-    action_results = []
-    for action in actions:
-        result = tools_map[action["name"]].invoke(data, **action["arguments"])
-        action_results.append(result)
-    return action_results
+    # Resolve every tool's invoke method up front, then call them in order
+    get = tools_map.__getitem__
+    resolved = [(get(action["name"]).invoke, action["arguments"]) for action in actions]
+    return [invoke(data, **arguments) for invoke, arguments in resolved]
+
+
+def maybe_parse_json(action_result):
+    """
+    Parse a tool result as JSON if it looks like JSON.
+    
+    Args:
+        action_result: Result returned by a tool
+        
+    Returns:
+        The parsed JSON value, or the original result if it is not JSON
+    """
+    # The stdlib parser is used because results may hold NaN or integers wider than 64 bits,
+    # which orjson rejects or turns into floats
+    if isinstance(action_result, str):
+        stripped = action_result.lstrip()
+        if stripped and stripped[0] in '{["-0123456789tfnNI':
+            try:
+                return json.loads(action_result)
+            except json.JSONDecodeError:
+                pass
+    return action_result
 
 
+@functools.lru_cache(maxsize=None)
 def load_domain_modules(domain):
     """
     Load domain-specific modules.
+    Results are cached per domain, so repeated calls return the same objects.
     
     Args:
         domain (str): Domain name (e.g., 'airline', 'retail')
@@ -181,6 +430,24 @@ def load_domain_modules(domain):
         sys.exit(1)
 
 
+@functools.lru_cache(maxsize=None)
+def get_tools_map(domain):
+    """
+    Get the mapping of tool names to tools for a domain.
+    Results are cached per domain, so the mapping is only built once.
+    
+    Args:
+        domain (str): Domain name
+        
+    Returns:
+        Dict[str, Tool]: Mapping of tool names to tool objects
+    """
+    ALL_TOOLS, _, _, _ = load_domain_modules(domain)
+    return {
+        tool.get_info()["function"]["name"]: tool for tool in ALL_TOOLS
+    }
+
+
 def refresh_setting(domain):
     """
     Refresh the data and tools mapping for a specific domain.
@@ -191,15 +458,45 @@ def refresh_setting(domain):
     Returns:
         tuple: (data, tools_map)
     """
-    ALL_TOOLS, load_data, _, _ = load_domain_modules(domain)
+    _, load_data, _, _ = load_domain_modules(domain)
     data = load_data()
-    tools_map: Dict[str, Type[Tool]] = {
-        tool.get_info()["function"]["name"]: tool for tool in ALL_TOOLS
-    }
+    tools_map = get_tools_map(domain)
     return data, tools_map
 
 
-def process_tasks(domain, task_indices=None, delay=15):
+async def generate_questions(selected_tasks, concurrency=8):
+    """
+    Generate questions for the selected tasks concurrently.
+    Each distinct instruction is sent to the model once and its question is shared by all its tasks.
+    
+    Args:
+        selected_tasks (List[tuple]): (index, task) pairs to generate questions for
+        concurrency (int): Maximum number of in-flight Bedrock requests
+    """
+    import asyncio
+    
+    semaphore = asyncio.Semaphore(concurrency)
+    
+    # Group the tasks by instruction
+    tasks_by_instruction: Dict[str, List[tuple]] = {}
+    for i, task in selected_tasks:
+        tasks_by_instruction.setdefault(task["instruction"], []).append((i, task))
+    
+    async with setup_async_bedrock_client() as bedrock_runtime:
+        async def process_one(instruction, instruction_tasks):
+            async with semaphore:
+                print(f"Generating question for task(s) {', '.join(str(i) for i, _ in instruction_tasks)}")
+                question = await generate_question(instruction, bedrock_runtime)
+            for _, task in instruction_tasks:
+                task["question"] = question
+        
+        await asyncio.gather(*[
+            process_one(instruction, instruction_tasks)
+            for instruction, instruction_tasks in tasks_by_instruction.items()
+        ])
+
+
+def process_tasks(domain, task_indices=None, concurrency=8, batch_bucket=None, batch_role_arn=None):
     """
     Process the tasks by generating questions and tool outputs.
     
@@ -207,13 +504,15 @@ def process_tasks(domain, task_indices=None, delay=15):
         domain (str): Domain name
         task_indices (List[int], optional): Indices of tasks to process. 
                                            If None, process all except specific indices.
-        delay (int): Delay in seconds between API calls
+        concurrency (int): Maximum number of in-flight Bedrock requests
+        batch_bucket (str, optional): S3 bucket for Bedrock batch inference
+        batch_role_arn (str, optional): IAM role for Bedrock batch inference
         
     Returns:
         List[dict]: Updated tasks with questions and action results
     """
-    # Initialize the bedrock client
-    bedrock_runtime = setup_bedrock_client()
+    # Imported here so --help and argument errors do not pay for loading asyncio
+    import asyncio
     
     # Load domain-specific modules
     _, _, tasks, _ = load_domain_modules(domain)
@@ -222,37 +521,48 @@ def process_tasks(domain, task_indices=None, delay=15):
     # Note: These indices are specific to the airline domain
     skip_indices = [5, 9, 24, 27, 28, 36, 38, 40, 41, 42, 44, 46] if domain == "airline" else []
     
-    for i, task in enumerate(tasks):
-        # Skip if task index is in skip_indices and we're processing all tasks
-        if task_indices is None and i in skip_indices:
-            continue
-            
-        # Skip if we're only processing specific tasks and this isn't one of them
-        if task_indices is not None and i not in task_indices:
-            continue
-            
+    if task_indices is None:
+        # Processing all tasks, minus the skipped ones
+        selected_tasks = [(i, task) for i, task in enumerate(tasks) if i not in skip_indices]
+    else:
+        # Only processing specific tasks
+        selected_tasks = [(i, task) for i, task in enumerate(tasks) if i in task_indices]
+    
+    # Use a batch inference job when there are enough uncached instructions.
+    # Its results land in the question cache, and any records it failed on
+    # are generated by the on-demand path below.
+    if batch_bucket and batch_role_arn:
+        pending = list(dict.fromkeys(
+            task["instruction"] for _, task in selected_tasks
+            if load_cached_question(task["instruction"]) is None
+        ))
+        if len(pending) >= BATCH_MIN_RECORDS:
+            generate_questions_batch(pending, batch_bucket, batch_role_arn)
+    
+    # Generate the questions
+    asyncio.run(generate_questions(selected_tasks, concurrency))
+    
+    # Do not save null ground truth; the good questions are cached, so a re-run only retries these
+    missing = [i for i, task in selected_tasks if task.get("question") is None]
+    if missing:
+        print(f"Error: no question generated for task(s) {', '.join(str(i) for i in missing)}; tasks not saved")
+        sys.exit(1)
+    
+    # Load the tools once. Tools mutate the data, so each task with actions gets freshly
+    # loaded data (re-parsing is cheaper than copy.deepcopy); tasks without actions share one load
+    base_data, tools_map = refresh_setting(domain)
+    _, load_data, _, _ = load_domain_modules(domain)
+    
+    for i, task in selected_tasks:
         print(f"Processing task {i}")
-        data, tools_map = refresh_setting(domain)
-
-        user_id = task["user_id"]
         actions = task["actions"]
-        instruction = task["instruction"]
-
-        # Generate the question
-        question = generate_question(instruction, bedrock_runtime)
-        task["question"] = question
+        data = load_data() if actions else base_data
 
         # Generate tool outputs
         action_results = generate_tooloutput(actions, tools_map, data)
         
-        # Try to parse JSON results
-        try:
-            task["action_results"] = [json.loads(action_result) for action_result in action_results]
-        except:
-            task["action_results"] = action_results
-
-        # Sleep to avoid rate limiting
-        time.sleep(delay)
+        # Parse the results that are JSON, keep the rest as returned
+        task["action_results"] = [maybe_parse_json(action_result) for action_result in action_results]
     
     return tasks
 
@@ -270,31 +580,113 @@ def save_tasks(tasks, domain):
     """
     output_path = os.path.join("..", "data", "tau-bench", "tau_bench", "envs", domain, "tasks_singleturn.json")
     
-    with open(output_path, "w") as file:
-        json.dump(tasks, file)
+    # orjson cannot encode integers wider than 64 bits; fall back to the stdlib for those
+    try:
+        output = orjson.dumps(tasks, option=orjson.OPT_NON_STR_KEYS)
+    except orjson.JSONEncodeError:
+        output = json.dumps(tasks).encode("utf-8")
+    
+    # The output is bytes, so the file is opened in binary mode
+    with open(output_path, "wb") as file:
+        file.write(output)
         
     return output_path
 
 
+USAGE = """usage: createGT.py --domain DOMAIN [--task-indices N [N ...]]
+                   [--batch-bucket BUCKET --batch-role-arn ARN]
+
+Generate ground truth data for specified domain
+
+options:
+  --domain DOMAIN          Domain name (e.g., 'airline', 'retail')
+  --task-indices N [N ...] Specific task indices to process
+  --batch-bucket BUCKET    S3 bucket for Bedrock batch inference
+  --batch-role-arn ARN     IAM role ARN for Bedrock batch inference
+
+Options take their value as the next argument or as --option=value.
+Option names must be written in full; abbreviations are not accepted."""
+
+
+def usage_error(message):
+    """
+    Print the usage and an error message, then exit.
+    
+    Args:
+        message (str): Error message
+    """
+    print(USAGE, file=sys.stderr)
+    print(f"error: {message}", file=sys.stderr)
+    sys.exit(2)
+
+
+def parse_args(argv):
+    """
+    Parse the command line arguments.
+    
+    Args:
+        argv (List[str]): Arguments without the program name
+        
+    Returns:
+        dict: domain, task_indices, batch_bucket and batch_role_arn
+    """
+    args = {"domain": None, "task_indices": None, "batch_bucket": None, "batch_role_arn": None}
+    
+    # Split '--option=value' into '--option' 'value'
+    argv = [part for arg in argv
+            for part in (arg.split("=", 1) if arg.startswith("--") and "=" in arg else [arg])]
+    
+    i = 0
+    while i < len(argv):
+        flag = argv[i]
+        if flag in ("-h", "--help"):
+            print(USAGE)
+            sys.exit(0)
+        elif flag == "--task-indices":
+            task_indices = []
+            while i + 1 < len(argv) and not argv[i + 1].startswith("--"):
+                i += 1
+                try:
+                    task_indices.append(int(argv[i]))
+                except ValueError:
+                    usage_error(f"invalid task index: '{argv[i]}'")
+            if not task_indices:
+                usage_error("--task-indices expects at least one index")
+            args["task_indices"] = task_indices
+        elif flag in ("--domain", "--batch-bucket", "--batch-role-arn"):
+            if i + 1 >= len(argv) or not argv[i + 1] or argv[i + 1].startswith("--"):
+                usage_error(f"{flag} expects a value")
+            i += 1
+            args[flag[2:].replace("-", "_")] = argv[i]
+        else:
+            usage_error(f"unrecognized argument: {flag}")
+        i += 1
+    
+    if args["domain"] is None:
+        usage_error("the following arguments are required: --domain")
+    
+    return args
+
+
 def main():
     """
     Main function to run the script.
     """
-    # Set up argument parser
-    parser = argparse.ArgumentParser(description="Generate ground truth data for specified domain")
-    parser.add_argument("--domain", type=str, required=True, help="Domain name (e.g., 'airline', 'retail')")
-    parser.add_argument("--task-indices", type=int, nargs="+", help="Specific task indices to process")
-    
-    args = parser.parse_args()
+    args = parse_args(sys.argv[1:])
     
     # Set the warning filter
     warnings.filterwarnings("ignore")
     
     # Process tasks for the specified domain
-    updated_tasks = process_tasks(args.domain, args.task_indices)
+    updated_tasks = process_tasks(
+        args["domain"],
+        args["task_indices"],
+        batch_bucket=args["batch_bucket"],
+        batch_role_arn=args["batch_role_arn"]
+    )
     
     # Save the updated tasks
-    output_path = save_tasks(updated_tasks, args.domain)
+    output_path = save_tasks(updated_tasks, args["domain"])
     print(f"Tasks saved to {output_path}")
 
 
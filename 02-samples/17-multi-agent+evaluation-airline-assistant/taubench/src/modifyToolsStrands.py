@@ -6,89 +6,278 @@ Script to add required code to tool files:
 3. Direct data loading code if not present
 4. Comment out 'data = get_data()' line
 
-The script first creates a copy of the tools folder named 'tools_strands' and then makes changes to the tools in the new folder.
+The script creates a copy of the tools folder named 'tools_strands', writing the changed tool files straight into the new folder.
 """
 
+import ast
+import concurrent.futures
 import os
 import re
 import shutil
+from functools import partial
 
-def update_tool_file(file_path, domain):
+# Patterns shared by every tool file
+_RE_IMPORT = re.compile(r'from\s+strands\s+import\s+tool')
+_RE_DECORATOR = re.compile(r'@tool')
+_RE_GETDATA = re.compile(r'data\s*=\s*get_data\(\)')
+_RE_IMPORT_BLOCK = re.compile(r'((?:^|\n)(?:from|import)[^\n]*(?:\n(?:from|import)[^\n]*)*)')
+_RE_DOCSTRING = re.compile(r'(""".*?"""|\'\'\'.*?\'\'\')\s*', re.DOTALL)
+_RE_FUNCDEF = re.compile(r'(?:^|\n)(def\s+\w+\s*\()')
+
+def compile_dataload_pattern(domain):
     """
-    Update a tool file with required changes.
+    Compile the pattern matching the domain's load_data import.
     
     Args:
-        file_path: Path to the file to modify
         domain: The domain name (e.g., 'airline' or 'retail')
     
     Returns:
-        bool: True if the file was modified, False otherwise
+        re.Pattern: Compiled pattern
+    """
+    return re.compile(rf'from\s+mabench\.environments\.{re.escape(domain)}\.data\s+import\s+load_data')
+
+def _line_starts(content):
+    """
+    Return the offset of the start of every line in content.
+    """
+    return [0] + [match.end() for match in re.finditer('\n', content)]
+
+def _source_offset(content, line_starts, lineno, col_offset):
+    """
+    Convert an AST (lineno, col_offset) position into an offset in content.
+    AST column offsets count UTF-8 bytes, so the line prefix is re-encoded.
+    """
+    line_start = line_starts[lineno - 1]
+    line = content[line_start:line_starts[lineno] if lineno < len(line_starts) else len(content)]
+    return line_start + len(line.encode('utf-8')[:col_offset].decode('utf-8', errors='ignore'))
+
+def _line_end(content, line_starts, lineno):
+    """
+    Return the offset of the end of a line in content, before its line terminator.
+    """
+    end = line_starts[lineno] - 1 if lineno < len(line_starts) else len(content)
+    if end > line_starts[lineno - 1] and content[end - 1] == '\r':
+        end -= 1
+    return end
+
+def _is_tool_decorator(node):
+    """
+    Check whether a decorator node is '@tool' or '@tool(...)'.
+    """
+    if isinstance(node, ast.Call):
+        node = node.func
+    return isinstance(node, ast.Name) and node.id == 'tool'
+
+def apply_edits(content, edits):
+    """
+    Apply (start, end, replacement) edits to content in a single pass.
+    
+    Args:
+        content: Original file content
+        edits: List of non-overlapping (start, end, replacement) tuples; edits at the same offset keep their order
+    
+    Returns:
+        str: The edited content
+    """
+    parts = []
+    prev_end = 0
+    for start, end, replacement in sorted(edits, key=lambda edit: edit[0]):
+        assert start >= prev_end, f"Overlapping edits at offset {start}"
+        parts.append(content[prev_end:start])
+        parts.append(replacement)
+        prev_end = end
+    parts.append(content[prev_end:])
+    return ''.join(parts)
+
+def find_edits_ast(content, domain):
+    """
+    Find the edits a tool file needs by parsing it once with the ast module.
+    
+    Args:
+        content: File content
+        domain: The domain name (e.g., 'airline' or 'retail')
+    
+    Returns:
+        list: (start, end, replacement) edits, empty if no changes are needed
+    
+    Raises:
+        SyntaxError: If the file cannot be parsed
+    """
+    tree = ast.parse(content)
+    line_starts = _line_starts(content)
+    data_module = f"mabench.environments.{domain}.data"
+    
+    # Check what we need to add
+    import_present = False
+    decorator_present = False
+    get_data_calls = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.ImportFrom) and node.module == 'strands':
+            import_present = import_present or any(alias.name == 'tool' for alias in node.names)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            decorator_present = decorator_present or any(_is_tool_decorator(d) for d in node.decorator_list)
+        elif (isinstance(node, ast.Assign)
+              and isinstance(node.value, ast.Call)
+              and isinstance(node.value.func, ast.Name)
+              and node.value.func.id == 'get_data'
+              and not node.value.args and not node.value.keywords
+              and any(isinstance(target, ast.Name) and target.id == 'data' for target in node.targets)):
+            get_data_calls.append(node.value)
+    
+    edits = []
+    
+    # Add import if needed
+    if not import_present:
+        new_imports = f"from strands import tool\nfrom {data_module} import load_data"
+        body = tree.body
+        first_import = next((i for i, node in enumerate(body) if isinstance(node, (ast.Import, ast.ImportFrom))), None)
+        if first_import is not None:
+            # Add after the line holding the last statement of the first block of imports,
+            # so any trailing comment stays on its own import
+            last_import = first_import
+            while last_import + 1 < len(body) and isinstance(body[last_import + 1], (ast.Import, ast.ImportFrom)):
+                last_import += 1
+            offset = _line_end(content, line_starts, body[last_import].end_lineno)
+            edits.append((offset, offset, f"\n{new_imports}"))
+        elif body and isinstance(body[0], ast.Expr) and isinstance(body[0].value, ast.Constant) and isinstance(body[0].value.value, str):
+            # No imports found, add after the line holding the module docstring
+            offset = _line_end(content, line_starts, body[0].end_lineno)
+            edits.append((offset, offset, f"\n{new_imports}"))
+        else:
+            edits.append((0, 0, f"{new_imports}\n\n"))
+    
+    # Replace get_data() with load_data()
+    for call in get_data_calls:
+        start = _source_offset(content, line_starts, call.lineno, call.col_offset)
+        end = _source_offset(content, line_starts, call.end_lineno, call.end_col_offset)
+        edits.append((start, end, "load_data()"))
+    
+    # Add decorator to the first function if needed, directly above 'def'
+    # (below any existing decorators, as in the regex fallback)
+    if not decorator_present:
+        func = next((node for node in tree.body if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef))), None)
+        if func is not None:
+            offset = line_starts[func.lineno - 1]
+            edits.append((offset, offset, "@tool\n"))
+    
+    return edits
+
+def find_edits_regex(content, domain, re_dataload):
     """
-    with open(file_path, 'r') as f:
-        content = f.read()
+    Find the edits a tool file needs with regular expressions.
+    Used for files the ast module cannot parse.
+    
+    Args:
+        content: File content
+        domain: The domain name (e.g., 'airline' or 'retail')
+        re_dataload: Precompiled pattern from compile_dataload_pattern(domain)
     
+    Returns:
+        list: (start, end, replacement) edits, empty if no changes are needed
+    """
     # Check what we need to add
-    import_present = re.search(r'from\s+strands\s+import\s+tool', content) is not None
-    decorator_present = re.search(r'@tool', content) is not None
-    get_data_call = re.search(r'data\s*=\s*get_data\(\)', content)
-    data_loading_present = re.search(fr'from\s+mabench\.environments\.{domain}\.data\s+import\s+load_data', content) is not None
+    import_present = _RE_IMPORT.search(content) is not None
+    decorator_present = _RE_DECORATOR.search(content) is not None
+    get_data_calls = list(_RE_GETDATA.finditer(content))
+    data_loading_present = re_dataload.search(content) is not None
     
     # If everything is already set up correctly, nothing to do
-    if import_present and decorator_present and data_loading_present and not get_data_call:
-        print(f"No changes needed for {file_path}")
-        return False
+    if import_present and decorator_present and data_loading_present and not get_data_calls:
+        return []
     
-    # Prepare the modified content
-    new_content = content
+    edits = []
     
     # Add import if needed
     if not import_present:
+        new_imports = f"from strands import tool\nfrom mabench.environments.{domain}.data import load_data"
         # Find a good place to add the import - after other imports but before code
-        import_match = re.search(r'((?:^|\n)(?:from|import)[^\n]*(?:\n(?:from|import)[^\n]*)*)', content)
+        import_match = _RE_IMPORT_BLOCK.search(content)
         if import_match:
             # Add after the last import statement
-            import_block = import_match.group(1)
-            new_content = new_content.replace(import_block, 
-                                             f"{import_block}\nfrom strands import tool\nfrom mabench.environments.{domain}.data import load_data\n")
+            edits.append((import_match.end(1), import_match.end(1), f"\n{new_imports}"))
         else:
             # No imports found, add at the top (after docstring if present)
-            docstring_match = re.match(r'(""".*?"""|\'\'\'.*?\'\'\')\s*', 
-                                      new_content, re.DOTALL)
+            docstring_match = _RE_DOCSTRING.match(content)
             if docstring_match:
-                docstring_end = docstring_match.end()
-                new_content = (new_content[:docstring_end] + 
-                              f"\nfrom strands import tool\nfrom mabench.environments.{domain}.data import load_data\n" + 
-                              new_content[docstring_end:])
+                edits.append((docstring_match.end(1), docstring_match.end(1), f"\n{new_imports}"))
             else:
-                new_content = f"from strands import tool\nfrom mabench.environments.{domain}.data import load_data\n\n" + new_content
+                edits.append((0, 0, f"{new_imports}\n\n"))
     
-    # Add data loading code if needed and replace get_data() with load_data()
-    if get_data_call:
-        # Replace get_data() with load_data()
-        new_content = new_content.replace(get_data_call.group(0), "data = load_data()")
+    # Replace get_data() with load_data()
+    for get_data_call in get_data_calls:
+        edits.append((get_data_call.start(), get_data_call.end(), "data = load_data()"))
     
     # Add decorator if needed
     if not decorator_present:
-        # Find the first function definition
-        func_match = re.search(r'(\ndef\s+\w+\s*\()', new_content)
+        # Find the first function definition and add the decorator on the line above it
+        func_match = _RE_FUNCDEF.search(content)
         if func_match:
-            # Add decorator before the function definition
-            func_def = func_match.group(1)
-            indentation = re.match(r'(\s*)', func_def).group(1)
-            new_content = new_content.replace(func_def, f"{indentation}@tool\n{func_def}")
+            edits.append((func_match.start(1), func_match.start(1), "@tool\n"))
+    
+    return edits
+
+def is_tool_file(filename):
+    """
+    Check whether a file in a tools directory is a tool module.
+    """
+    return filename.endswith('.py') and not filename.startswith('__')
+
+def get_tools_dir(domain, dirname="tools"):
+    """
+    Return the path of a tools directory for the given domain.
+    """
+    return os.path.join("..", "data", "ma-bench", "mabench", "environments", domain, dirname)
+
+def update_tool_file(file_path, domain, re_dataload=None, output_dir=None):
+    """
+    Update a tool file with required changes.
+    
+    Args:
+        file_path: Path to the file to modify
+        domain: The domain name (e.g., 'airline' or 'retail')
+        re_dataload: Optional precompiled pattern from compile_dataload_pattern(domain)
+        output_dir: Optional directory to write the result to instead of updating the file in place
     
-    # Write the modified content back to the file
-    if new_content != content:
-        with open(file_path, 'w') as f:
-            f.write(new_content)
-        print(f"Updated {file_path}")
-        return True
+    Returns:
+        bool: True if the file was modified, False otherwise
+    """
+    # Binary mode skips universal-newline translation; decode once
+    with open(file_path, 'rb') as f:
+        content = f.read().decode('utf-8')
     
-    return False
+    try:
+        edits = find_edits_ast(content, domain)
+    except SyntaxError:
+        # Fall back to regular expressions for files that do not parse
+        if re_dataload is None:
+            re_dataload = compile_dataload_pattern(domain)
+        edits = find_edits_regex(content, domain, re_dataload)
+    
+    new_content = apply_edits(content, edits)
+    
+    modified = new_content != content
+    
+    # Write the output file, or the modified content back to the original file
+    if output_dir:
+        output_path = os.path.join(output_dir, os.path.basename(file_path))
+    else:
+        output_path = file_path
+    
+    if modified or output_path != file_path:
+        with open(output_path, 'wb') as f:
+            f.write(new_content.encode('utf-8'))
+    
+    if modified:
+        print(f"Updated {output_path}")
+    else:
+        print(f"No changes needed for {output_path}")
+    return modified
 
 def copy_tools_directory(domain):
     """
     Create a copy of the tools directory for the given domain with the name 'tools_strands'.
+    Tool files are not copied here; process_tools_directory writes their updated
+    versions into the copy so each one is only read and written once.
     
     Args:
         domain: The domain name (e.g., 'airline')
@@ -97,10 +286,10 @@ def copy_tools_directory(domain):
         str: Path to the copied tools directory
     """
     # Original tools directory
-    original_tools_dir = os.path.join("..", "data", "ma-bench", "mabench", "environments", domain, "tools")
+    original_tools_dir = get_tools_dir(domain)
     
     # Create a copy with the fixed name 'tools_strands'
-    copy_tools_dir = os.path.join("..", "data", "ma-bench", "mabench", "environments", domain, "tools_strands")
+    copy_tools_dir = get_tools_dir(domain, "tools_strands")
     
     print(f"Creating a copy of tools directory: {copy_tools_dir}")
     
@@ -113,25 +302,32 @@ def copy_tools_directory(domain):
         print(f"Removing existing copy directory: {copy_tools_dir}")
         shutil.rmtree(copy_tools_dir)
     
-    # Create the copy
-    shutil.copytree(original_tools_dir, copy_tools_dir)
+    # Create the copy, skipping the top-level tool files
+    for dirpath, _, filenames in os.walk(original_tools_dir):
+        dest_dir = os.path.join(copy_tools_dir, os.path.relpath(dirpath, original_tools_dir))
+        os.makedirs(dest_dir, exist_ok=True)
+        for filename in filenames:
+            if dirpath == original_tools_dir and is_tool_file(filename):
+                continue
+            shutil.copyfile(os.path.join(dirpath, filename), os.path.join(dest_dir, filename))
     print(f"Copy created successfully at: {copy_tools_dir}")
     
     return copy_tools_dir
 
-def process_tools_directory(domain, custom_tools_dir=None):
+def process_tools_directory(domain, custom_tools_dir=None, output_dir=None):
     """
     Process all tool files in the given domain's tools directory.
     
     Args:
         domain: The domain name (e.g., 'airline')
         custom_tools_dir: Optional path to a custom tools directory
+        output_dir: Optional directory to write the updated files to instead of updating them in place
     
     Returns:
         tuple: (number of files processed, number of files modified)
     """
     # Use custom directory if provided, otherwise use the default path
-    tools_dir = custom_tools_dir if custom_tools_dir else os.path.join("..", "data", "ma-bench", "mabench", "environments", domain, "tools")
+    tools_dir = custom_tools_dir if custom_tools_dir else get_tools_dir(domain)
     
     print(f"Looking for tools in: {os.path.abspath(tools_dir)}")
     
@@ -139,19 +335,17 @@ def process_tools_directory(domain, custom_tools_dir=None):
         print(f"Directory not found: {tools_dir}")
         return 0, 0
     
-    processed = 0
-    modified = 0
+    re_dataload = compile_dataload_pattern(domain)
     
     # Get all Python files in the directory
-    for filename in os.listdir(tools_dir):
-        if filename.endswith('.py') and not filename.startswith('__'):
-            file_path = os.path.join(tools_dir, filename)
-            processed += 1
-            
-            if update_tool_file(file_path, domain):
-                modified += 1
+    with os.scandir(tools_dir) as entries:
+        file_paths = [entry.path for entry in entries if entry.is_file() and is_tool_file(entry.name)]
     
-    return processed, modified
+    # Files are independent, so update them in parallel across processes
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        results = list(executor.map(partial(update_tool_file, domain=domain, re_dataload=re_dataload, output_dir=output_dir), file_paths))
+    
+    return len(file_paths), sum(results)
 
 if __name__ == "__main__":
     import sys
@@ -159,14 +353,18 @@ if __name__ == "__main__":
     # Default to 'airline' domain if not specified
     domain = sys.argv[1] if len(sys.argv) > 1 else "airline"
     
+    if domain.startswith("-") or len(sys.argv) > 2:
+        print("usage: modifyToolsStrands.py [domain_name]")
+        sys.exit(0 if domain in ("-h", "--help") else 2)
+    
     print(f"Processing tools for domain: {domain}")
     
     # First create a copy of the tools directory
     copied_tools_dir = copy_tools_directory(domain)
     
     if copied_tools_dir:
-        # Then process the copied directory
-        processed, modified = process_tools_directory(domain, copied_tools_dir)
+        # Then write the updated tool files into the copied directory
+        processed, modified = process_tools_directory(domain, get_tools_dir(domain), copied_tools_dir)
         print(f"Processed {processed} files, modified {modified} files in the copied directory: {os.path.basename(copied_tools_dir)}")
     else:
         print("Failed to create a copy of the tools directory. Process aborted.")